@@ -0,0 +1,46 @@
+'''Websocket protocol for the legacy client of websockets<14.
+
+Only imported by stream2 when websockets.connect is the legacy client,
+as newer websockets releases warn on importing it.  The asyncio client
+of websockets>=13 is asked for bytes with recv(decode=False) instead.
+'''
+from websockets.exceptions import ProtocolError
+
+try:
+    from websockets.legacy.client import WebSocketClientProtocol
+except ImportError:  # websockets<10
+    from websockets.client import WebSocketClientProtocol
+
+try:
+    from websockets.frames import OP_CONT
+except ImportError:  # websockets<10
+    from websockets.framing import OP_CONT
+
+
+class BytesClientProtocol(WebSocketClientProtocol):
+    '''Client protocol that returns text frames as their raw utf-8 bytes
+    instead of decoding them into str.  orjson parses and validates the
+    bytes itself, so the intermediate str is never built.
+    '''
+
+    async def read_message(self):
+        frame = await self.read_data_frame(max_size=self.max_size)
+        if frame is None:
+            return None
+        if frame.opcode == OP_CONT:
+            raise ProtocolError('unexpected opcode')
+        if frame.fin:
+            return frame.data
+
+        fragments = [frame.data]
+        max_size = self.max_size
+        while not frame.fin:
+            if max_size is not None:
+                max_size -= len(frame.data)
+            frame = await self.read_data_frame(max_size=max_size)
+            if frame is None:
+                raise ProtocolError('incomplete fragmented message')
+            if frame.opcode != OP_CONT:
+                raise ProtocolError('unexpected opcode')
+            fragments.append(frame.data)
+        return b''.join(fragments)
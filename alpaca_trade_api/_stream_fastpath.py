@@ -0,0 +1,55 @@
+'''Per-message helpers for the stream connections.
+
+This is plain python, but setup.py compiles it with Cython when Cython
+is available, so keep it free of coroutines.  The async loops stay in
+stream2 and call into these synchronous functions for every message.
+'''
+from .entity import Account, Entity
+from .polygon.entity import (
+    Trade, Quote, Agg, trade_mapping, agg_mapping, quote_mapping
+)
+
+_trade_mapping_items = tuple(trade_mapping.items())
+_quote_mapping_items = tuple(quote_mapping.items())
+_agg_mapping_items = tuple(agg_mapping.items())
+
+# entity class and (source, destination) key pairs used to cast
+# messages, keyed by the channel name up to the first '.'
+CAST_TABLE = {
+    'T': (Trade, _trade_mapping_items),
+    'Q': (Quote, _quote_mapping_items),
+    'A': (Agg, _agg_mapping_items),
+    'AM': (Agg, _agg_mapping_items),
+    'account_updates': (Account, None),
+}
+
+
+def cast(channel, msg):
+    '''Wraps the message data of the channel in its entity class.'''
+    entry = CAST_TABLE.get(channel.partition('.')[0])
+    if entry is None:
+        return Entity(msg)
+    cls, mapping_items = entry
+    if mapping_items is None:
+        return cls(msg)
+    return cls.from_raw(msg, mapping_items)
+
+
+def match_handlers(channel, exact_handlers, prefix_handlers,
+                   regex_handlers):
+    '''Returns the handlers to call for the channel: the ones registered
+    for the exact name, then the matching ones from the channel's prefix
+    bucket, then the matching catch-all patterns.  Bucketed handlers
+    come with a None matcher when they take the whole bucket.
+    '''
+    handlers = exact_handlers.get(channel, [])
+    head, sep, _ = channel.partition('.')
+    if sep:
+        bucket = prefix_handlers.get(head)
+        if bucket:
+            handlers = handlers + [
+                h for match, h in bucket if match is None or match(channel)]
+    matched = [h for match, h in regex_handlers if match(channel)]
+    if matched:
+        handlers = handlers + matched
+    return handlers
@@ -1,4 +1,11 @@
+import asyncio
 import os
+import random
+
+# asyncio.get_running_loop is new in python 3.7; within a coroutine
+# get_event_loop returns the same running loop
+get_running_loop = getattr(
+    asyncio, 'get_running_loop', asyncio.get_event_loop)
 
 
 def get_base_url():
@@ -53,3 +60,13 @@ def get_api_version(api_version):
         api_version = 'v2'
 
     return api_version
+
+
+def get_reconnect_wait(retry_wait, retries):
+    '''Seconds to wait before a stream reconnect attempt, after
+    `retries` (>= 1) failed ones: retry_wait, doubling with each retry up
+    to a minute, plus jitter so that clients don't all reconnect at once
+    after an outage.
+    '''
+    wait = min(retry_wait * (2 ** (retries - 1)), 60)
+    return wait + random.uniform(0, retry_wait)
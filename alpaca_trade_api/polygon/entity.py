@@ -5,9 +5,18 @@ NY = 'America/New_York'
 
 
 class Entity(object):
+    __slots__ = ('_raw',)
+
     def __init__(self, raw):
         self._raw = raw
 
+    @classmethod
+    def from_raw(cls, msg, mapping_items):
+        '''Builds the entity from a stream message, renaming its keys by
+        the (source, destination) pairs of mapping_items.
+        '''
+        return cls({dst: msg[src] for src, dst in mapping_items if src in msg})
+
     def __getattr__(self, key):
         if key in self._raw:
             val = self._raw[key]
@@ -22,6 +31,8 @@ class Entity(object):
 
 
 class Agg(Entity):
+    __slots__ = ()
+
     def __getattr__(self, key):
         if key in self._raw:
             val = self._raw[key]
@@ -141,6 +152,7 @@ class Aggsv2Set(dict):
 
 class _TradeOrQuote(object):
     '''Mixin for Trade and Quote'''
+    __slots__ = ()
 
     def __getattr__(self, key):
         if key in self._raw:
@@ -220,7 +232,7 @@ class _TradesOrQuotes(object):
 
 
 class Trade(_TradeOrQuote, Entity):
-    pass
+    __slots__ = ()
 
 
 class Trades(_TradesOrQuotes, list):
@@ -234,7 +246,7 @@ class TradesV2(_TradesOrQuotes, list):
 
 
 class Quote(_TradeOrQuote, Entity):
-    pass
+    __slots__ = ()
 
 
 class Quotes(_TradesOrQuotes, list):
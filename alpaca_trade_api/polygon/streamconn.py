@@ -1,6 +1,5 @@
 import asyncio
 import json
-import time
 import re
 import os
 import websockets
@@ -8,7 +7,9 @@ from .entity import (
     Quote, Trade, Agg, Entity,
     trade_mapping, quote_mapping, agg_mapping
 )
-from alpaca_trade_api.common import get_polygon_credentials
+from alpaca_trade_api.common import (
+    get_polygon_credentials, get_reconnect_wait, get_running_loop
+)
 import logging
 
 
@@ -21,7 +22,7 @@ class StreamConn(object):
         ).rstrip('/')
         self._handlers = {}
         self._handler_symbols = {}
-        self._streams = set([])
+        self._streams = set()
         self._ws = None
         self._retry = int(os.environ.get('APCA_RETRY_MAX', 3))
         self._retry_wait = int(os.environ.get('APCA_RETRY_WAIT', 3))
@@ -33,7 +34,12 @@ class StreamConn(object):
         await self._dispatch({'ev': 'status',
                               'status': 'connecting',
                               'message': 'Connecting to Polygon'})
-        self._ws = await websockets.connect(self._endpoint)
+        self._ws = await websockets.connect(
+            self._endpoint,
+            max_size=2 ** 22,
+            max_queue=512,
+            compression=None,
+        )
         self._stream = self._recv()
 
         msg = await self._next()
@@ -44,7 +50,8 @@ class StreamConn(object):
             )
         await self._dispatch(msg)
         if await self.authenticate():
-            self._consume_task = asyncio.ensure_future(self._consume_msg())
+            self._consume_task = get_running_loop().create_task(
+                self._consume_msg())
         else:
             await self.close()
 
@@ -96,7 +103,7 @@ class StreamConn(object):
                                   'message':
                                   f'Polygon Disconnected Unexpectedly ({e})'})
             await self.close()
-            asyncio.ensure_future(self._ensure_ws())
+            get_running_loop().create_task(self._ensure_ws())
 
     async def _consume_msg(self):
         async for data in self._stream:
@@ -128,7 +135,8 @@ class StreamConn(object):
                                       f'Polygon Connection Failed ({e})'})
                 self._ws = None
                 self._retries += 1
-                time.sleep(self._retry_wait * self._retry)
+                await asyncio.sleep(
+                    get_reconnect_wait(self._retry_wait, self._retries))
         else:
             raise ConnectionError("Max Retries Exceeded")
 
@@ -145,7 +153,7 @@ class StreamConn(object):
             await self._ensure_ws()
             # Join channel list to string
             streams = ','.join(channels)
-            self._streams |= set(channels)
+            self._streams.update(channels)
             await self._ws.send(json.dumps({
                 'action': 'subscribe',
                 'params': streams
@@ -159,7 +167,7 @@ class StreamConn(object):
         if len(channels) > 0:
             # Join channel list to string
             streams = ','.join(channels)
-            self._streams -= set(channels)
+            self._streams.difference_update(channels)
             await self._ws.send(json.dumps({
                 'action': 'unsubscribe',
                 'params': streams
@@ -189,14 +197,11 @@ class StreamConn(object):
 
     def _cast(self, subject, data):
         if subject == 'T':
-            return Trade({trade_mapping[k]: v for k,
-                          v in data.items() if k in trade_mapping})
+            return Trade.from_raw(data, trade_mapping.items())
         if subject == 'Q':
-            return Quote({quote_mapping[k]: v for k,
-                          v in data.items() if k in quote_mapping})
+            return Quote.from_raw(data, quote_mapping.items())
         if subject == 'AM' or subject == 'A':
-            return Agg({agg_mapping[k]: v for k,
-                        v in data.items() if k in agg_mapping})
+            return Agg.from_raw(data, agg_mapping.items())
         return Entity(data)
 
     async def _dispatch(self, msg):
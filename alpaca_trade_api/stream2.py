@@ -1,16 +1,121 @@
 import asyncio
-import json
+import functools
+import inspect
+import orjson
 import os
 import re
+import sys
+import time
 import websockets
-from .common import get_base_url, get_data_url, get_credentials
-from .entity import Account, Entity
-from . import polygon
-from .polygon.entity import (
-    Trade, Quote, Agg, trade_mapping, agg_mapping, quote_mapping
+from .common import (
+    get_base_url, get_data_url, get_credentials, get_reconnect_wait,
+    get_running_loop,
 )
+from . import polygon
+from ._stream_fastpath import cast, match_handlers
 import logging
 
+# the legacy client of websockets<14 decodes text frames in its protocol,
+# so it gets a protocol that hands back the raw bytes instead
+if 'create_protocol' in inspect.signature(websockets.connect).parameters:
+    from ._legacy_protocol import BytesClientProtocol
+    _CONNECT_OPTIONS = {'create_protocol': BytesClientProtocol}
+else:
+    _CONNECT_OPTIONS = {}
+
+if sys.version_info >= (3, 12):
+    def _eager_task(coro):
+        '''Starts a handler gathered by _dispatch right away, so one that
+        returns without awaiting finishes without being scheduled.
+        '''
+        return asyncio.Task(
+            coro, loop=asyncio.get_running_loop(), eager_start=True)
+else:
+    _eager_task = None
+
+# seconds between warnings about messages dropped from a full queue
+_DROP_REPORT_INTERVAL = 10
+
+_TRADING_CHANNELS = frozenset(('trade_updates', 'account_updates'))
+_POLYGON_PREFIXES = frozenset(('T', 'Q', 'A', 'AM'))
+
+
+def _is_polygon_channel(channel):
+    prefix, sep, _ = channel.partition('.')
+    return bool(sep) and prefix in _POLYGON_PREFIXES
+
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]()|\\')
+_REGEX_QUANTIFIERS = frozenset('*+?{')
+
+
+def _literal_prefix(pat):
+    r'''Splits the compiled pattern into the literal text every match
+    starts with and the rest of the pattern source, e.g.
+    r'^T\.AAPL$' -> ('T.AAPL', '$') and r'Q\..*' -> ('Q.', '.*').
+    Patterns that can't be reasoned about this way (alternations,
+    flags) return ('', source).
+    '''
+    source = pat.pattern
+    if pat.flags & ~re.UNICODE or '|' in source:
+        return '', source
+    i = 1 if source.startswith('^') else 0
+    prefix = []
+    while i < len(source):
+        c = source[i]
+        step = 1
+        if c == '\\':
+            c = source[i + 1:i + 2]
+            if not c or c.isalnum():
+                break
+            step = 2
+        elif c in _REGEX_SPECIAL:
+            break
+        if source[i + step:i + step + 1] in _REGEX_QUANTIFIERS:
+            break
+        prefix.append(c)
+        i += step
+    if not prefix:
+        return '', source
+    return ''.join(prefix), source[i:]
+
+
+def _startswith(prefix):
+    '''A cheaper stand-in for re.match of a pattern that is only a
+    literal prefix.
+    '''
+    return lambda channel: channel.startswith(prefix)
+
+
+def _raw_recv(ws):
+    '''Returns the recv coroutine function of the websocket, set up to
+    hand back text frames as undecoded bytes when the websockets version
+    supports it (the asyncio client of websockets>=13).  orjson parses
+    the bytes directly, so the utf-8 decode into a str is skipped.
+    '''
+    try:
+        params = inspect.signature(ws.recv).parameters
+    except (TypeError, ValueError):
+        return ws.recv
+    if 'decode' in params:
+        return functools.partial(ws.recv, decode=False)
+    return ws.recv
+
+
+def _install_uvloop():
+    '''Make uvloop the default event loop if it is available, unless
+    disabled with APCA_USE_UVLOOP=0.
+    '''
+    if os.environ.get('APCA_USE_UVLOOP', '1') == '0':
+        return
+    try:
+        import uvloop
+    except ImportError:
+        return
+    if not isinstance(asyncio.get_event_loop_policy(),
+                      uvloop.EventLoopPolicy):
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 
 class _StreamConn(object):
     def __init__(self, key_id, secret_key, base_url):
@@ -18,28 +123,45 @@ class _StreamConn(object):
         self._secret_key = secret_key
         self._base_url = re.sub(r'^http', 'ws', base_url)
         self._endpoint = self._base_url + '/stream'
+        # serialized once and resent on every reconnect; control messages
+        # go out as text frames, hence the decode
+        self._auth_msg = orjson.dumps({
+            'action': 'authenticate',
+            'data': {
+                'key_id': key_id,
+                'secret_key': secret_key,
+            }
+        }).decode()
         self._handlers = {}
         self._handler_symbols = {}
-        self._streams = set([])
+        self._exact_handlers = {}
+        self._prefix_handlers = {}
+        self._regex_handlers = []
+        self._streams = set()
         self._ws = None
         self._retry = int(os.environ.get('APCA_RETRY_MAX', 3))
         self._retry_wait = int(os.environ.get('APCA_RETRY_WAIT', 3))
         self._retries = 0
+        self._queue_max = int(os.environ.get('APCA_QUEUE_MAX', 1024))
+        # created in _connect, as before python 3.10 a queue is bound to
+        # the loop current at construction, not the one the stream runs on
+        self._queue = None
         self._consume_task = None
+        self._dispatch_task = None
 
     async def _connect(self):
-        ws = await websockets.connect(self._endpoint)
-        await ws.send(json.dumps({
-            'action': 'authenticate',
-            'data': {
-                'key_id': self._key_id,
-                'secret_key': self._secret_key,
-            }
-        }))
+        # market data frames are small json, so permessage-deflate costs
+        # more cpu than it saves in bandwidth
+        ws = await websockets.connect(
+            self._endpoint,
+            max_size=2 ** 22,
+            max_queue=512,
+            compression=None,
+            **_CONNECT_OPTIONS
+        )
+        await ws.send(self._auth_msg)
         r = await ws.recv()
-        if isinstance(r, bytes):
-            r = r.decode('utf-8')
-        msg = json.loads(r)
+        msg = orjson.loads(r)
 
         if msg.get('data', {}).get('status') != 'authorized':
             raise ValueError(
@@ -50,25 +172,73 @@ class _StreamConn(object):
             self._retries = 0
 
         self._ws = ws
-        await self._dispatch('authorized', msg)
-
-        self._consume_task = asyncio.ensure_future(self._consume_msg())
+        await self._dispatch('authorized', msg['data'])
+
+        # these tasks outlive reconnects, so they are only started when
+        # they are not running yet
+        loop = get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self._queue_max)
+        if self._consume_task is None or self._consume_task.done():
+            self._consume_task = loop.create_task(self._consume_msg())
+        if self._dispatch_task is None or self._dispatch_task.done():
+            self._dispatch_task = loop.create_task(self._dispatch_msg())
 
     async def _consume_msg(self):
-        ws = self._ws
-        try:
-            while True:
-                r = await ws.recv()
-                if isinstance(r, bytes):
-                    r = r.decode('utf-8')
-                msg = json.loads(r)
-                stream = msg.get('stream')
-                if stream is not None:
-                    await self._dispatch(stream, msg)
-        except websockets.WebSocketException as wse:
-            logging.warn(wse)
-            await self.close()
-            asyncio.ensure_future(self._ensure_ws())
+        '''Reads messages off the websocket into the queue, reconnecting
+        on failure. When the handlers fall behind and the queue is full,
+        the oldest message is dropped so the socket is never stalled.
+        '''
+        queue = self._queue
+        put = queue.put_nowait
+        loads = orjson.loads
+        dropped, reported_at = 0, None
+        while True:
+            ws = self._ws
+            recv = _raw_recv(ws)
+            try:
+                while True:
+                    msg = loads(await recv())
+                    stream = msg.get('stream')
+                    if stream is None:
+                        continue
+                    item = (stream, msg['data'])
+                    try:
+                        put(item)
+                    except asyncio.QueueFull:
+                        queue.get_nowait()
+                        put(item)
+                        dropped += 1
+                        # report drops at most every few seconds, as
+                        # this can happen on every frame of a busy feed
+                        now = time.monotonic()
+                        if (reported_at is None or
+                                now - reported_at >= _DROP_REPORT_INTERVAL):
+                            logging.warning(
+                                'stream queue is full, dropped {} '
+                                'message(s)'.format(dropped))
+                            dropped, reported_at = 0, now
+            except websockets.WebSocketException as wse:
+                logging.warn(wse)
+                self._ws = None
+                await ws.close()
+                await self._ensure_ws()
+
+    async def _dispatch_msg(self):
+        '''Hands queued messages to the registered handlers. A handler
+        that raises is logged and doesn't stop the messages after it.
+        '''
+        get = self._queue.get
+        dispatch = self._dispatch
+        while True:
+            stream, data = await get()
+            try:
+                await dispatch(stream, data)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(
+                    'error in the handler of {}'.format(stream))
 
     async def _ensure_ws(self):
         if self._ws is not None:
@@ -84,20 +254,23 @@ class _StreamConn(object):
                 logging.warn(wse)
                 self._ws = None
                 self._retries += 1
-                await asyncio.sleep(self._retry_wait * self._retry)
+                await asyncio.sleep(
+                    get_reconnect_wait(self._retry_wait, self._retries))
         else:
             raise ConnectionError("Max Retries Exceeded")
 
     async def subscribe(self, channels):
         if len(channels) > 0:
             await self._ensure_ws()
-            self._streams |= set(channels)
-            await self._ws.send(json.dumps({
+            self._streams.update(channels)
+            # channels is the set of streams on resubscribe, which orjson
+            # doesn't serialize
+            await self._ws.send(orjson.dumps({
                 'action': 'listen',
                 'data': {
-                    'streams': channels,
+                    'streams': list(channels),
                 }
-            }))
+            }).decode())
 
     async def unsubscribe(self, channels):
         # Currently our streams don't support unsubscribe
@@ -107,29 +280,66 @@ class _StreamConn(object):
     async def close(self):
         if self._consume_task:
             self._consume_task.cancel()
+            self._consume_task = None
+        if self._dispatch_task:
+            self._dispatch_task.cancel()
+            self._dispatch_task = None
+        # messages left over are stale by the time of a later subscribe
+        self._queue = None
         if self._ws:
             await self._ws.close()
             self._ws = None
 
-    def _cast(self, channel, msg):
-        if channel == 'account_updates':
-            return Account(msg)
-        if channel.startswith('T.'):
-            return Trade({trade_mapping[k]: v for k,
-                          v in msg.items() if k in trade_mapping})
-        if channel.startswith('Q.'):
-            return Quote({quote_mapping[k]: v for k,
-                          v in msg.items() if k in quote_mapping})
-        if channel.startswith('A.') or channel.startswith('AM.'):
-            return Agg({agg_mapping[k]: v for k,
-                        v in msg.items() if k in agg_mapping})
-        return Entity(msg)
-
-    async def _dispatch(self, channel, msg):
+    _cast = staticmethod(cast)
+
+    async def _dispatch(self, channel, data):
+        handlers = match_handlers(
+            channel, self._exact_handlers, self._prefix_handlers,
+            self._regex_handlers)
+        if not handlers:
+            return
+        ent = self._cast(channel, data)
+        if len(handlers) == 1:
+            await handlers[0](self, channel, ent)
+        else:
+            coros = [h(self, channel, ent) for h in handlers]
+            if _eager_task is not None:
+                coros = [_eager_task(c) for c in coros]
+            await asyncio.gather(*coros)
+
+    def _index_handlers(self):
+        r'''Sorts the registered handlers for _dispatch: the ones bound to
+        a single channel name (e.g. r'^trade_updates$') are looked up
+        by name, patterns with a literal 'X.' prefix are bucketed by 'X'
+        so only those are tried on 'X.*' channels, and the rest are
+        matched against every channel.
+
+        Each bucketed handler is paired with its matcher: None if it
+        takes every channel of the bucket (e.g. r'T\..*'), a startswith
+        check if the pattern is just a literal prefix, otherwise the
+        compiled pattern's match.
+        '''
+        exact, prefixed, regex = {}, {}, []
         for pat, handler in self._handlers.items():
-            if pat.match(channel):
-                ent = self._cast(channel, msg['data'])
-                await handler(self, channel, ent)
+            prefix, rest = _literal_prefix(pat)
+            head, sep, _ = prefix.partition('.')
+            if prefix and rest == '$':
+                exact.setdefault(prefix, []).append(handler)
+                continue
+            if prefix and rest in ('', '.*'):
+                if sep and prefix == head + sep:
+                    match = None
+                else:
+                    match = _startswith(prefix)
+            else:
+                match = pat.match
+            if sep:
+                prefixed.setdefault(head, []).append((match, handler))
+            else:
+                regex.append((match, handler))
+        self._exact_handlers = exact
+        self._prefix_handlers = prefixed
+        self._regex_handlers = regex
 
     def on(self, channel_pat, symbols=None):
         def decorator(func):
@@ -145,12 +355,14 @@ class _StreamConn(object):
             channel_pat = re.compile(channel_pat)
         self._handlers[channel_pat] = func
         self._handler_symbols[func] = symbols
+        self._index_handlers()
 
     def deregister(self, channel_pat):
         if isinstance(channel_pat, str):
             channel_pat = re.compile(channel_pat)
         self._handler_symbols.pop(self._handlers[channel_pat], None)
         del self._handlers[channel_pat]
+        self._index_handlers()
 
 
 class StreamConn(object):
@@ -161,12 +373,17 @@ class StreamConn(object):
             secret_key=None,
             base_url=None,
             data_url=None):
+        _install_uvloop()
         _key_id, _secret_key, _ = get_credentials(key_id, secret_key)
         _base_url = base_url or get_base_url()
         _data_url = data_url or get_data_url()
 
         self.trading_ws = _StreamConn(_key_id, _secret_key, _base_url)
-        self.data_ws = _StreamConn(_key_id, _secret_key, _data_url)
+        if _data_url == _base_url:
+            # one connection carries both the trading and data channels
+            self.data_ws = self.trading_ws
+        else:
+            self.data_ws = _StreamConn(_key_id, _secret_key, _data_url)
         self.polygon = polygon.StreamConn(
             _key_id + '-staging' if 'staging' in _base_url else '')
 
@@ -183,8 +400,8 @@ class StreamConn(object):
     async def _ensure_ws(self, conn):
         if conn._handlers:
             return
-        conn._handlers = self._handlers.copy()
-        conn._handler_symbols = self._handler_symbols.copy()
+        for pat, func in self._handlers.items():
+            conn.register(pat, func, self._handler_symbols.get(func))
         if isinstance(conn, _StreamConn):
             await conn._connect()
         else:
@@ -195,13 +412,20 @@ class StreamConn(object):
         If the necessary connection isn't open yet, it opens now.
         '''
         trading_channels, data_channels, polygon_channels = [], [], []
+        add_trading = trading_channels.append
+        add_data = data_channels.append
+        add_polygon = polygon_channels.append
         for c in channels:
-            if c.startswith(('Q.', 'T.', 'A.', 'AM.',)):
-                polygon_channels.append(c)
-            elif c in ('trade_updates', 'account_updates'):
-                trading_channels.append(c)
+            if c in _TRADING_CHANNELS:
+                add_trading(c)
+            elif _is_polygon_channel(c):
+                add_polygon(c)
             else:
-                data_channels.append(c)
+                add_data(c)
+
+        if self.data_ws is self.trading_ws:
+            trading_channels += data_channels
+            data_channels = []
 
         if trading_channels:
             await self._ensure_ws(self.trading_ws)
@@ -215,10 +439,7 @@ class StreamConn(object):
 
     async def unsubscribe(self, channels):
         '''Handle unsubscribing from channels.'''
-        polygon_channels = [
-            c for c in channels
-            if c.startswith(('Q.', 'T.', 'A.', 'AM.',))
-        ]
+        polygon_channels = [c for c in channels if _is_polygon_channel(c)]
         if polygon_channels:
             await self.polygon.unsubscribe(polygon_channels)
 
@@ -265,7 +486,7 @@ class StreamConn(object):
 
         if self.trading_ws:
             self.trading_ws.register(channel_pat, func, symbols)
-        if self.data_ws:
+        if self.data_ws and self.data_ws is not self.trading_ws:
             self.data_ws.register(channel_pat, func, symbols)
         if self.polygon:
             self.polygon.register(channel_pat, func, symbols)
@@ -278,7 +499,7 @@ class StreamConn(object):
 
         if self.trading_ws:
             self.trading_ws.deregister(channel_pat)
-        if self.data_ws:
+        if self.data_ws and self.data_ws is not self.trading_ws:
             self.data_ws.deregister(channel_pat)
         if self.polygon:
             self.polygon.deregister(channel_pat)
@@ -2,7 +2,9 @@
 
 import ast
 import re
+import warnings
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
 
 _version_re = re.compile(r'__version__\s+=\s+(.*)')
 
@@ -13,6 +15,36 @@ with open('alpaca_trade_api/__init__.py', 'rb') as f:
 with open('README.md') as readme_file:
     README = readme_file.read()
 
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    # the stream hot path is plain python; compiling it is optional
+    ext_modules = cythonize(
+        ['alpaca_trade_api/_stream_fastpath.py'],
+        compiler_directives={'language_level': 3},
+    )
+
+
+class optional_build_ext(build_ext):
+    '''Falls back to the pure python modules if an extension fails to
+    build, e.g. when no C compiler is available.
+    '''
+
+    def run(self):
+        try:
+            super().run()
+        except Exception as e:
+            warnings.warn('skipping compiled extensions: {}'.format(e))
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception as e:
+            warnings.warn('skipping {}: {}'.format(ext.name, e))
+
+
 setup(
     name='alpaca-trade-api',
     version=version,
@@ -35,9 +67,13 @@ setup(
         'urllib3<1.25',
         'websocket-client',
         'websockets>=8.0',
+        'orjson',
         'deprecated',
         'alpha_vantage',
     ],
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     tests_require=[
         'pytest',
         'pytest-cov',
@@ -48,4 +84,6 @@ setup(
         'deprecated',
     ],
     setup_requires=['pytest-runner', 'flake8'],
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': optional_build_ext},
 )
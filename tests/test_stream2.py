@@ -1,11 +1,15 @@
-from alpaca_trade_api.stream2 import StreamConn
+from alpaca_trade_api.stream2 import StreamConn, _raw_recv
 from alpaca_trade_api.polygon import StreamConn as PolyStream
+from alpaca_trade_api.common import get_reconnect_wait
 from alpaca_trade_api.entity import Account
+from alpaca_trade_api.polygon.entity import Agg, Trade
 import asyncio
 import json
+import sys
 
 import pytest
 from unittest import mock
+from websockets.exceptions import InvalidState
 
 
 def AsyncMock(*args, **kwargs):
@@ -51,7 +55,13 @@ def test_stream(websockets):
         on_auth.msg = msg
     _run(conn._connect())
     assert on_auth.msg.status == 'authorized'
+    assert connect.mock.call_args[1]['compression'] is None
+    assert isinstance(ws.send.mock.call_args[0][0], str)
     assert conn._consume_msg.mock.called
+    assert conn._dispatch_task is not None
+    ws.close = AsyncMock()
+    _run(conn.close())
+    assert conn._dispatch_task is None
 
     conn.deregister('authorized')
     assert len(conn._handlers) == 0
@@ -94,6 +104,24 @@ def test_stream(websockets):
     _run(conn._ensure_ws(conn.trading_ws))
     assert conn.trading_ws._connect.mock.called
 
+    # reconnect backoff, counted from the first failed attempt
+    assert 3 <= get_reconnect_wait(3, 1) < 6
+    assert 12 <= get_reconnect_wait(3, 3) < 15
+    assert 60 <= get_reconnect_wait(3, 10) < 63
+
+    # shared trading and data connection
+    conn = StreamConn('key-id', 'secret-key', base_url='https://example.com',
+                      data_url='https://example.com')
+    assert conn.data_ws is conn.trading_ws
+    conn.register('T.AAPL', on_raise)
+    conn.deregister('T.AAPL')
+    conn._ensure_ws = AsyncMock()
+    conn.trading_ws.subscribe = AsyncMock()
+    _run(conn.subscribe(['trade_updates', 'alpacadatav1/T.SPY']))
+    assert conn.trading_ws.subscribe.mock.call_count == 1
+    assert conn.trading_ws.subscribe.mock.call_args[0][0] == [
+        'trade_updates', 'alpacadatav1/T.SPY']
+
     # subscribe
     conn = StreamConn('key-id', 'secret-key').trading_ws
     conn._ensure_ws = AsyncMock()
@@ -103,6 +131,25 @@ def test_stream(websockets):
 
     _run(conn.subscribe(['Q.*', 'account_updates']))
     assert conn._ws.send.mock.called
+    _run(conn.subscribe({'account_updates'}))
+    sent = conn._ws.send.mock.call_args[0][0]
+    assert isinstance(sent, str)
+    assert json.loads(sent) == {
+        'action': 'listen', 'data': {'streams': ['account_updates']}}
+
+    # _ensure_ws resubscribes with the set of streams after a reconnect
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    conn._streams = {'trade_updates', 'account_updates'}
+    ws = mock.Mock()
+    ws.send = AsyncMock()
+
+    async def reconnect():
+        conn._ws = ws
+    conn._connect = reconnect
+    _run(conn._ensure_ws())
+    sent = json.loads(ws.send.mock.call_args[0][0])
+    assert sorted(sent['data']['streams']) == [
+        'account_updates', 'trade_updates']
 
     # close
     conn = StreamConn('key-id', 'secret-key').trading_ws
@@ -117,6 +164,60 @@ def test_stream(websockets):
     assert isinstance(ent, Account)
     ent = conn._cast('other', {'key': 'value'})
     assert ent.key == 'value'
+    ent = conn._cast('T.AAPL', {'sym': 'AAPL', 'p': 100.5, 'z': 3})
+    assert isinstance(ent, Trade)
+    assert ent.symbol == 'AAPL'
+    assert ent.price == 100.5
+    assert 'z' not in ent._raw
+    assert not hasattr(ent, '__dict__')
+    ent = conn._cast('AM.AAPL', {'o': 1.0})
+    assert isinstance(ent, Agg)
+    assert ent.open == 1.0
+
+    # _dispatch
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    received = []
+
+    @conn.on(r'^trade_updates$')
+    async def on_trade_updates(conn, channel, data):
+        received.append(('exact', channel, data.event))
+
+    @conn.on(r'trade_.*')
+    async def on_trade_any(conn, channel, data):
+        received.append(('regex', channel, data.event))
+
+    assert list(conn._exact_handlers) == ['trade_updates']
+    assert len(conn._regex_handlers) == 1
+    _run(conn._dispatch('trade_updates', {'event': 'fill'}))
+    _run(conn._dispatch('trade_other', {'event': 'new'}))
+    # gathered handlers may start in any order
+    assert sorted(received) == [
+        ('exact', 'trade_updates', 'fill'),
+        ('regex', 'trade_other', 'new'),
+        ('regex', 'trade_updates', 'fill'),
+    ]
+    conn.deregister(r'^trade_updates$')
+    assert conn._exact_handlers == {}
+
+    @conn.on(r'T\.A')
+    async def on_trade_a(conn, channel, data):
+        received.append(('prefix', channel, data.symbol))
+
+    assert list(conn._prefix_handlers) == ['T']
+    del received[:]
+    _run(conn._dispatch('T.AAPL', {'sym': 'AAPL'}))
+    _run(conn._dispatch('T.MSFT', {'sym': 'MSFT'}))
+    _run(conn._dispatch('Q.AAPL', {'sym': 'AAPL'}))
+    assert received == [('prefix', 'T.AAPL', 'AAPL')]
+
+    @conn.on(r'T\..*')
+    async def on_any_trade(conn, channel, data):
+        received.append(('any', channel, data.symbol))
+
+    assert [m for m, _ in conn._prefix_handlers['T']][1] is None
+    del received[:]
+    _run(conn._dispatch('T.MSFT', {'sym': 'MSFT'}))
+    assert received == [('any', 'T.MSFT', 'MSFT')]
 
     # polygon _dispatch
     conn = StreamConn('key-id', 'secret-key')
@@ -130,3 +231,198 @@ def test_stream(websockets):
 
     _run(conn.polygon._dispatch(msg_data))
     assert on_q.data['key'] == 'value'
+
+
+def test_consume_msg_reconnects():
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+
+    class StopConsuming(Exception):
+        pass
+
+    broken = mock.Mock()
+    broken.recv = AsyncMock(side_effect=InvalidState())
+    broken.close = AsyncMock()
+    fresh = mock.Mock()
+    fresh.recv = AsyncMock(side_effect=StopConsuming())
+
+    async def ensure_ws():
+        conn._ws = fresh
+    conn._ensure_ws = ensure_ws
+    conn._ws = broken
+    conn._queue = asyncio.Queue()
+
+    with pytest.raises(StopConsuming):
+        _run(conn._consume_msg())
+    assert broken.close.mock.called
+    assert fresh.recv.mock.called
+
+
+def test_consume_msg_drops_oldest():
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    conn._queue = asyncio.Queue(maxsize=2)
+
+    class StopConsuming(Exception):
+        pass
+
+    conn._ws = mock.Mock()
+    conn._ws.recv = AsyncMock(side_effect=[
+        json.dumps({'stream': 'T.{}'.format(i), 'data': {}})
+        for i in range(5)
+    ] + [json.dumps({'data': {}}), StopConsuming()])
+
+    with mock.patch('alpaca_trade_api.stream2.logging') as logging:
+        with pytest.raises(StopConsuming):
+            _run(conn._consume_msg())
+    # three drops within the report interval give a single warning
+    assert logging.warning.call_count == 1
+    assert conn._queue.get_nowait()[0] == 'T.3'
+    assert conn._queue.get_nowait()[0] == 'T.4'
+    assert conn._queue.empty()
+
+
+def test_close_clears_queue():
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    conn._queue = asyncio.Queue()
+    conn._queue.put_nowait(('T.AAPL', {}))
+    _run(conn.close())
+    assert conn._queue is None
+
+
+def test_stream_runs_on_another_loop(websockets):
+    # the conn is built before the loop it runs on exists
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    frames = [
+        json.dumps({'stream': 'authorization',
+                    'data': {'status': 'authorized'}}),
+        json.dumps({'stream': 'trade_updates', 'data': {'event': 'fill'}}),
+    ]
+
+    async def recv():
+        if frames:
+            return frames.pop(0)
+        await asyncio.sleep(3600)
+
+    ws = mock.Mock()
+    ws.recv = recv
+    ws.send = AsyncMock()
+    ws.close = AsyncMock()
+    websockets.connect = AsyncMock(return_value=ws)
+    received = []
+
+    @conn.on(r'^trade_updates$')
+    async def on_trade_updates(conn, channel, data):
+        received.append(data.event)
+
+    async def run():
+        await conn._connect()
+        for _ in range(10):
+            if received:
+                break
+            await asyncio.sleep(0)
+        await conn.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert received == ['fill']
+
+
+def test_dispatch_msg_survives_handler_error():
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    received = []
+
+    @conn.on(r'^trade_updates$')
+    async def on_trade_updates(conn, channel, data):
+        if data.event == 'bad':
+            raise ValueError(data.event)
+        received.append(data.event)
+
+    async def dispatch():
+        conn._queue = asyncio.Queue()
+        task = asyncio.ensure_future(conn._dispatch_msg())
+        conn._queue.put_nowait(('trade_updates', {'event': 'bad'}))
+        conn._queue.put_nowait(('trade_updates', {'event': 'fill'}))
+        while not conn._queue.empty():
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert not task.done()
+        task.cancel()
+
+    with mock.patch('alpaca_trade_api.stream2.logging') as logging:
+        _run(dispatch())
+    assert received == ['fill']
+    assert logging.exception.called
+
+
+def test_raw_recv():
+    class Connection:
+        async def recv(self, decode=None):
+            return b'{}' if decode is False else '{}'
+
+    class LegacyConnection:
+        async def recv(self):
+            return '{}'
+
+    assert _run(_raw_recv(Connection())()) == b'{}'
+    assert _run(_raw_recv(LegacyConnection())()) == '{}'
+
+
+def test_bytes_client_protocol():
+    from types import SimpleNamespace
+    from alpaca_trade_api._legacy_protocol import (
+        BytesClientProtocol, OP_CONT
+    )
+
+    def frame(data, fin=True, opcode=1):
+        return SimpleNamespace(opcode=opcode, data=data, fin=fin)
+
+    proto = BytesClientProtocol.__new__(BytesClientProtocol)
+    proto.max_size = 2 ** 20
+    proto.read_data_frame = AsyncMock(side_effect=[
+        frame(b'{"stream":'),
+        frame(b'{"a":', fin=False),
+        frame(b'1}', opcode=OP_CONT),
+    ])
+    assert _run(proto.read_message()) == b'{"stream":'
+    assert _run(proto.read_message()) == b'{"a":1}'
+    assert proto.read_data_frame.mock.call_args[1]['max_size'] == 2 ** 20 - 5
+
+
+@pytest.mark.skipif(sys.version_info < (3, 12),
+                    reason='eager task start needs python 3.12')
+def test_dispatch_starts_handlers_eagerly():
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    # StreamConn leaves the loop's task factory alone
+    assert asyncio.get_event_loop().get_task_factory() is None
+    started = []
+
+    @conn.on(r'^trade_updates$')
+    async def first(conn, channel, data):
+        started.append('first')
+
+    @conn.on(r'trade_.*')
+    async def second(conn, channel, data):
+        started.append('second')
+
+    async def dispatch():
+        task = asyncio.ensure_future(
+            conn._dispatch('trade_updates', {'event': 'fill'}))
+        # with eager start both handlers have run before the first
+        # yield to the loop
+        await asyncio.sleep(0)
+        assert started == ['first', 'second']
+        await task
+    _run(dispatch())
+
+
+def test_ensure_ws_first_retry_waits_retry_wait():
+    conn = StreamConn('key-id', 'secret-key').trading_ws
+    conn._retry_wait = 3
+    conn._connect = AsyncMock(side_effect=[InvalidState(), None])
+    with mock.patch('alpaca_trade_api.stream2.asyncio.sleep') as sleep:
+        sleep.side_effect = AsyncMock()
+        _run(conn._ensure_ws())
+    assert sleep.call_count == 1
+    assert 3 <= sleep.call_args[0][0] < 6